@@ -0,0 +1,102 @@
+import io
+import zipfile
+import pandas as pd
+import numpy as np
+from pyarrow import csv as pacsv, compute as pc
+from scipy.spatial.distance import pdist
+
+try:
+    from fastcluster import linkage
+except ImportError:
+    from scipy.cluster.hierarchy import linkage
+
+
+# --- NUMERIC HELPERS ---
+def threshold_counts(arr: np.ndarray, threshold: float):
+    return np.count_nonzero(arr > threshold, axis=1), np.count_nonzero(arr < -threshold, axis=1)
+
+
+def correlation_distance(X: np.ndarray) -> np.ndarray:
+    dist = pdist(np.asarray(X, dtype=np.float64), metric='correlation')
+    # Constant rows have no correlation; treat them as uncorrelated so linkage accepts them
+    return np.nan_to_num(dist, copy=False, nan=1.0)
+
+
+def compute_linkage(heatmap_arr: np.ndarray):
+    row_linkage = linkage(correlation_distance(heatmap_arr), method='average')
+    col_linkage = linkage(correlation_distance(heatmap_arr.T), method='average')
+    return row_linkage, col_linkage
+
+
+# --- LOADING ---
+REQUIRED_COLUMNS = ['ID_geneid', 'Name_GeneSymbol', 'Value_LogDiffExp', 'Significance_pvalue']
+
+
+def load_cell_line_data(subzip: zipfile.ZipFile, drug_name: str, pvalue_threshold: float):
+    # Only top-level CSVs count, so folders such as __MACOSX/ are skipped
+    csv_members = [info for info in subzip.infolist() if "/" not in info.filename and info.filename.endswith(".csv")]
+    cell_line_data = {}
+    warnings = []
+
+    for info in csv_members:
+        try:
+            file_name = info.filename
+            if " - " in file_name:
+                cell_line = file_name.split(" - ")[0].replace(drug_name, "").replace(".xls", "").strip()
+                with subzip.open(info) as csv_file:
+                    tbl = pacsv.read_csv(csv_file, convert_options=pacsv.ConvertOptions(include_columns=REQUIRED_COLUMNS))
+                tbl = tbl.filter(pc.less_equal(tbl['Significance_pvalue'], pvalue_threshold))
+                tbl = tbl.drop_columns(['Significance_pvalue'])
+                df = tbl.to_pandas(types_mapper=pd.ArrowDtype)
+                cell_line_data[cell_line] = df
+        except Exception as e:
+            warnings.append(f"⚠️ Failed to load {file_name}: {e}")
+
+    return cell_line_data, warnings
+
+
+# --- PER-DRUG PIPELINE ---
+def analyze_drug(subzip_bytes: bytes, drug_name: str, params: dict) -> dict:
+    # Runs in a worker process, so it must not touch Streamlit
+    with zipfile.ZipFile(io.BytesIO(subzip_bytes), 'r') as subzip:
+        cell_line_data, warnings = load_cell_line_data(subzip, drug_name, params["pvalue_threshold"])
+
+    result = {"drug_name": drug_name, "warnings": warnings, "cell_line_count": len(cell_line_data)}
+    if not cell_line_data:
+        return result
+
+    # --- Merge ---
+    gene_dfs = []
+    for cell_line, df in cell_line_data.items():
+        temp = df.set_index(['ID_geneid', 'Name_GeneSymbol'])['Value_LogDiffExp'].rename(cell_line)
+        gene_dfs.append(temp[~temp.index.duplicated()])
+
+    merged_df = gene_dfs[0].to_frame().join(gene_dfs[1:], how='outer', sort=True)
+
+    # --- Filter ---
+    min_consistent = int(len(cell_line_data) * (params["consistency_threshold"] / 100))
+
+    arr = merged_df.to_numpy(dtype=np.float32, na_value=0.0)
+    up_counts, down_counts = threshold_counts(arr, params["log2fc_threshold"])
+
+    up_mask = up_counts >= min_consistent
+    down_mask = down_counts >= min_consistent
+
+    # --- Heatmap ---
+    consistent_mask = up_mask | down_mask
+    heatmap_data = pd.DataFrame(arr[consistent_mask], index=merged_df.index[consistent_mask], columns=merged_df.columns)
+
+    row_linkage = col_linkage = None
+    if not heatmap_data.empty:
+        row_linkage, col_linkage = compute_linkage(heatmap_data.to_numpy())
+
+    result.update({
+        "gene_count": merged_df.shape[0],
+        "up_genes": merged_df.index[up_mask],
+        "down_genes": merged_df.index[down_mask],
+        "heatmap_data": heatmap_data,
+        "row_linkage": row_linkage,
+        "col_linkage": col_linkage,
+        "csv": merged_df.reset_index().to_csv(index=False).encode('utf-8'),
+    })
+    return result
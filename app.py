@@ -1,17 +1,21 @@
 import io
+import os
+import multiprocessing
+import threading
+from collections import OrderedDict, deque
+from functools import partial
+import zipfile
 import streamlit as st
 import pandas as pd
-import numpy as np
-import os
-import tempfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 import seaborn as sns
 import matplotlib.pyplot as plt
-from functools import reduce
-from scipy.cluster.hierarchy import linkage
-from scipy.spatial.distance import pdist
 import gseapy as gp
 from gseapy.plot import barplot
 
+from analysis import analyze_drug
+
 # --- STREAMLIT CONFIG ---
 st.set_page_config(layout="wide")
 st.title("🧬 Batch Gene Signature Analysis from Zipped Drug Treatments")
@@ -29,53 +33,160 @@ consistency_threshold = st.sidebar.slider("Cell Line Consistency Threshold (%)",
 pvalue_threshold = st.sidebar.slider("Significance P-Value Threshold", min_value=0.0, max_value=0.2, value=0.2, step=0.01)
 
 
-# --- ANALYSIS FUNCTION ---
-def run_analysis(cell_line_data: dict, drug_name: str):
-    report_lines = []
-    report_lines.append(f"📊 Summary for {drug_name}")
-
-    # --- Merge ---
-    gene_dfs = []
-    for cell_line, df in cell_line_data.items():
-        temp = df[['ID_geneid', 'Name_GeneSymbol', 'Value_LogDiffExp']].copy()
-        temp = temp.rename(columns={'Value_LogDiffExp': cell_line})
-        gene_dfs.append(temp)
-
-    merged_df = reduce(lambda left, right: pd.merge(left, right, on=['ID_geneid', 'Name_GeneSymbol'], how='outer'), gene_dfs)
-    merged_df.set_index(['ID_geneid', 'Name_GeneSymbol'], inplace=True)
-
-    # --- Filter ---
-    cell_line_count = len(cell_line_data)
-    min_consistent = int(cell_line_count * (consistency_threshold / 100))
+# --- WORKER POOL ---
+MAX_WORKERS = min(4, os.cpu_count() or 1)
+
+
+# One pool per server process, so reruns don't pay for spawning workers again.
+# Spawn rather than fork: the Streamlit server is multi-threaded.
+@st.cache_resource
+def get_worker_pool() -> ProcessPoolExecutor:
+    return ProcessPoolExecutor(max_workers=MAX_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+
+
+# --- RESULT CACHE ---
+MAX_CACHED_BYTES = 128 * 1024 * 1024
+
+
+def result_size(result: dict) -> int:
+    size = len(result.get("csv", b""))
+    if "heatmap_data" in result:
+        size += result["heatmap_data"].memory_usage(deep=True).sum()
+        size += result["up_genes"].memory_usage(deep=True) + result["down_genes"].memory_usage(deep=True)
+    return int(size)
+
+
+class ResultCache:
+    # LRU of drug results bounded by their approximate in-memory size. Locked because
+    # worker completion callbacks write to it from the executor's thread.
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: tuple):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key: tuple, result: dict):
+        size = result_size(result)
+        with self._lock:
+            if key in self._entries:
+                self._size -= self._entries.pop(key)[1]
+            if size > self.max_bytes:
+                return
+            self._entries[key] = (result, size)
+            self._size += size
+            while self._size > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._size -= evicted_size
+
+
+# Scoped to the browser session, so results from one user's upload are never served
+# to another. Keyed by drug, sub-ZIP checksum and slider values, so a rerun with inputs
+# already seen (download clicks, returning to an earlier slider value) skips the worker.
+def get_result_cache() -> ResultCache:
+    if "result_cache" not in st.session_state:
+        st.session_state["result_cache"] = ResultCache(MAX_CACHED_BYTES)
+    return st.session_state["result_cache"]
+
+
+def iter_drug_results(zipf: zipfile.ZipFile, subzip_names: list, params: dict):
+    # Drugs are independent and CPU-bound, so each one runs in a worker process.
+    # Each sub-ZIP is read just before it is submitted and at most MAX_WORKERS are in
+    # flight, so peak memory stays near the upload plus a few sub-ZIPs. Results are
+    # yielded in submission order so the page layout is stable across reruns.
+    cache = get_result_cache()
+    pool = get_worker_pool()
+    pending = deque()
+    in_flight = 0
+
+    def store(key, future):
+        # Runs on completion even if a rerun has dropped this generator, so the work is reused
+        if not future.cancelled() and future.exception() is None:
+            cache.put(key, future.result())
+
+    def resolve(key, future, result):
+        if future is None:
+            return result
+        try:
+            return future.result()
+        except BrokenProcessPool:
+            # A dead worker breaks the pool for good; start a fresh one on the next run
+            get_worker_pool.clear()
+            raise
+
+    try:
+        for name in subzip_names:
+            info = zipf.getinfo(name)
+            key = (name, info.CRC, info.file_size, tuple(sorted(params.items())))
+            cached = cache.get(key)
+            if cached is not None:
+                pending.append((key, None, cached))
+                continue
+
+            while in_flight >= MAX_WORKERS:
+                entry = pending.popleft()
+                in_flight -= entry[1] is not None
+                yield resolve(*entry)
+            future = pool.submit(analyze_drug, zipf.read(name), name.replace(".zip", ""), params)
+            future.add_done_callback(partial(store, key))
+            pending.append((key, future, None))
+            in_flight += 1
+
+        while pending:
+            yield resolve(*pending.popleft())
+    finally:
+        # A rerun interrupts rendering: drop drugs still queued; running ones finish into the cache
+        for _, future, _ in pending:
+            if future is not None:
+                future.cancel()
+
+
+# --- ENRICHMENT ---
+@st.cache_data(show_spinner=False)
+def fetch_enrichment(symbols: tuple) -> pd.DataFrame:
+    enr = gp.enrichr(
+        gene_list=list(symbols),
+        gene_sets=["KEGG_2021_Human", "Reactome_2022", "GO_Biological_Process_2023"],
+        organism='Human',
+        outdir=None,
+        cutoff=0.05
+    )
+    return enr.results
 
-    upregulated_mask = (merged_df > log2fc_threshold).sum(axis=1)
-    downregulated_mask = (merged_df < -log2fc_threshold).sum(axis=1)
 
-    consistently_up_genes = upregulated_mask[upregulated_mask >= min_consistent].index
-    consistently_down_genes = downregulated_mask[downregulated_mask >= min_consistent].index
+# --- RESULTS RENDERING ---
+def render_analysis(result: dict):
+    drug_name = result["drug_name"]
+    consistently_up_genes = result["up_genes"]
+    consistently_down_genes = result["down_genes"]
 
-    report_lines.append(f"Total genes in matrix: {merged_df.shape[0]}")
+    report_lines = []
+    report_lines.append(f"📊 Summary for {drug_name}")
+    report_lines.append(f"Total genes in matrix: {result['gene_count']}")
     report_lines.append(f"Genes upregulated in ≥{consistency_threshold}% cell lines: {len(consistently_up_genes)}")
     report_lines.append(f"Genes downregulated in ≥{consistency_threshold}% cell lines: {len(consistently_down_genes)}\n")
 
     st.subheader("📊 Summary")
-    st.write(f"**Total genes in matrix:** {merged_df.shape[0]}")
+    st.write(f"**Total genes in matrix:** {result['gene_count']}")
     st.write(f"**Genes upregulated in ≥{consistency_threshold}% cell lines:** {len(consistently_up_genes)}")
     st.write(f"**Genes downregulated in ≥{consistency_threshold}% cell lines:** {len(consistently_down_genes)}")
 
     # --- Heatmap ---
-    consistent_genes = consistently_up_genes.union(consistently_down_genes)
-    heatmap_data = merged_df.loc[consistent_genes].fillna(0)
+    heatmap_data = result["heatmap_data"]
 
     if not heatmap_data.empty:
-        row_linkage = linkage(pdist(heatmap_data, metric='correlation'), method='average')
-        col_linkage = linkage(pdist(heatmap_data.T, metric='correlation'), method='average')
-
         st.subheader("🧯 Hierarchical Clustering Heatmap")
         fig = sns.clustermap(
             heatmap_data,
-            row_linkage=row_linkage,
-            col_linkage=col_linkage,
+            row_linkage=result["row_linkage"],
+            col_linkage=result["col_linkage"],
             cmap='RdBu_r',
             center=0,
             linewidths=0.5,
@@ -84,16 +195,16 @@ def run_analysis(cell_line_data: dict, drug_name: str):
         st.pyplot(fig.fig)
 
         # Save heatmap
-        heatmap_file_path = os.path.join(tempfile.gettempdir(), f"{drug_name}_heatmap.png")
-        fig.savefig(heatmap_file_path)
-
-        with open(heatmap_file_path, "rb") as img_file:
-            st.download_button(
-                label=f"📸 Download Heatmap for {drug_name}",
-                data=img_file,
-                file_name=f"{drug_name}_heatmap.png",
-                mime="image/png"
-            )
+        heatmap_buffer = io.BytesIO()
+        fig.savefig(heatmap_buffer, format='png')
+        plt.close(fig.fig)
+
+        st.download_button(
+            label=f"📸 Download Heatmap for {drug_name}",
+            data=heatmap_buffer.getvalue(),
+            file_name=f"{drug_name}_heatmap.png",
+            mime="image/png"
+        )
     else:
         st.warning("⚠️ No consistent genes for heatmap.")
         report_lines.append("No consistent genes for heatmap.\n")
@@ -101,39 +212,50 @@ def run_analysis(cell_line_data: dict, drug_name: str):
     # --- Enrichment ---
     st.subheader("🔬 Pathway Enrichment")
 
-    def run_enrichment(gene_set, label):
+    gene_sets = {
+        "Upregulated": consistently_up_genes,
+        "Downregulated": consistently_down_genes,
+    }
+    # Sorted so the cache key doesn't depend on gene order
+    symbol_sets = {
+        label: tuple(sorted(genes.get_level_values('Name_GeneSymbol').dropna().unique()))
+        for label, genes in gene_sets.items()
+    }
+
+    def run_enrichment(label, future):
         report_lines.append(f"Top enriched pathways in {label} genes:\n")
-        if len(gene_set) == 0:
+        if future is None:
             report_lines.append(f"- No genes available for enrichment in {label} set.\n")
             return
-        symbols = [gene[1] for gene in gene_set]
         try:
-            enr = gp.enrichr(
-                gene_list=symbols,
-                gene_sets=["KEGG_2021_Human", "Reactome_2022", "GO_Biological_Process_2023"],
-                organism='Human',
-                outdir=None,
-                cutoff=0.05
-            )
-            if enr.results.empty:
+            results = future.result()
+            if results.empty:
                 st.info(f"No significant enrichment found for {label}.")
                 report_lines.append(f"- No significant enrichment found for {label}.\n")
             else:
                 st.write(f"**Top enriched pathways in {label} genes:**")
-                st.dataframe(enr.results.head(10))
+                st.dataframe(results.head(10))
                 fig, ax = plt.subplots(figsize=(10, 6))
-                barplot(enr.results.sort_values('Adjusted P-value').head(10), title=f"{label} Enrichment", ax=ax)
+                barplot(results.sort_values('Adjusted P-value').head(10), title=f"{label} Enrichment", ax=ax)
                 st.pyplot(fig)
+                plt.close(fig)
 
-                top = enr.results.sort_values('Adjusted P-value').head(10)
+                top = results.sort_values('Adjusted P-value').head(10)
                 report_lines.append(top[['Term', 'Adjusted P-value']].to_string(index=False))
                 report_lines.append("\n")
         except Exception as e:
             report_lines.append(f"⚠️ Error during enrichment for {label}: {str(e)}\n")
             st.error(f"Error during enrichment for {label}: {e}")
 
-    run_enrichment(consistently_up_genes, "Upregulated")
-    run_enrichment(consistently_down_genes, "Downregulated")
+    # Enrichr requests are network-bound, so both sets are fetched concurrently
+    with ThreadPoolExecutor(max_workers=len(symbol_sets)) as executor:
+        # Identical up/down symbol sets share a single request
+        futures = {
+            symbols: executor.submit(fetch_enrichment, symbols)
+            for symbols in set(symbol_sets.values()) if symbols
+        }
+        for label, symbols in symbol_sets.items():
+            run_enrichment(label, futures.get(symbols))
 
     # --- Download Report ---
     report_text = "\n".join(report_lines)
@@ -146,56 +268,40 @@ def run_analysis(cell_line_data: dict, drug_name: str):
     )
 
     # --- Download Merged CSV ---
-    csv_download = merged_df.reset_index().to_csv(index=False).encode('utf-8')
     st.download_button(
         label=f"📥 Download Merged Gene Expression Data for {drug_name}",
-        data=csv_download,
+        data=result["csv"],
         file_name=f"{drug_name}_expression_matrix.csv",
         mime='text/csv'
     )
 
 
 # --- ZIP UPLOAD ---
-st.subheader("📁 Upload ZIP of Drug ZIPs")
-uploaded_main_zip = st.file_uploader("Upload main ZIP file (contains drug ZIPs)", type="zip")
-
-if uploaded_main_zip:
-    with tempfile.TemporaryDirectory() as tmpdir:
-        zip_path = os.path.join(tmpdir, "main.zip")
-        with open(zip_path, "wb") as f:
-            f.write(uploaded_main_zip.read())
-
-        with zipfile.ZipFile(zip_path, 'r') as zipf:
-            zipf.extractall(tmpdir)
-
-        subzips = [os.path.join(tmpdir, f) for f in os.listdir(tmpdir) if f.endswith(".zip")]
-
-        if not subzips:
-            st.error("❌ No sub-zip files found in uploaded archive.")
-        else:
-            for subzip_path in subzips:
-                drug_name = os.path.basename(subzip_path).replace(".zip", "")
-                st.markdown(f"---\n### 💊 Processing Drug: `{drug_name}`")
-
-                extract_path = os.path.join(tmpdir, drug_name)
-                with zipfile.ZipFile(subzip_path, 'r') as subzip:
-                    subzip.extractall(extract_path)
-
-                csv_files = [os.path.join(extract_path, f) for f in os.listdir(extract_path) if f.endswith(".csv")]
-                cell_line_data = {}
-
-                for csv_path in csv_files:
-                    try:
-                        file_name = os.path.basename(csv_path)
-                        if " - " in file_name:
-                            cell_line = file_name.split(" - ")[0].replace(drug_name, "").replace(".xls", "").strip()
-                            df = pd.read_csv(csv_path)
-                            df = df[df['Significance_pvalue'] <= pvalue_threshold]
-                            cell_line_data[cell_line] = df
-                    except Exception as e:
-                        st.warning(f"⚠️ Failed to load {file_name}: {e}")
-
-                if cell_line_data:
-                    run_analysis(cell_line_data, drug_name)
-                else:
-                    st.warning(f"No valid cell line data found in `{drug_name}` ZIP.")
+# Spawned workers re-import this script as __mp_main__; only the Streamlit run processes uploads
+if __name__ == "__main__":
+    st.subheader("📁 Upload ZIP of Drug ZIPs")
+    uploaded_main_zip = st.file_uploader("Upload main ZIP file (contains drug ZIPs)", type="zip")
+
+    if uploaded_main_zip:
+        with zipfile.ZipFile(uploaded_main_zip, 'r') as zipf:
+            subzip_names = [name for name in zipf.namelist() if "/" not in name and name.endswith(".zip")]
+
+            if not subzip_names:
+                st.error("❌ No sub-zip files found in uploaded archive.")
+            else:
+                params = {
+                    "log2fc_threshold": log2fc_threshold,
+                    "consistency_threshold": consistency_threshold,
+                    "pvalue_threshold": pvalue_threshold,
+                }
+                for result in iter_drug_results(zipf, subzip_names, params):
+                    drug_name = result["drug_name"]
+                    st.markdown(f"---\n### 💊 Processing Drug: `{drug_name}`")
+
+                    for warning in result["warnings"]:
+                        st.warning(warning)
+
+                    if result["cell_line_count"]:
+                        render_analysis(result)
+                    else:
+                        st.warning(f"No valid cell line data found in `{drug_name}` ZIP.")